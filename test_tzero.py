@@ -1,5 +1,14 @@
 """Tests for tzero module."""
 
+import http
+import json
+import logging
+import pathlib
+import socket
+import threading
+
+import pytest
+
 import tzero
 
 # ruff: noqa: S101, SLF001
@@ -32,3 +41,499 @@ def test_format_duration() -> None:
     assert tzero._format_duration(172802) == "2 days 2 seconds"
     assert tzero._format_duration(172860) == "2 days 1 minute"
     assert tzero._format_duration(172920) == "2 days 2 minutes"
+
+
+def test_response_cache() -> None:
+    """Test _run_command() caching and invalidation."""
+    tzero._Ctx.state = {"count": 0, "minutes": 0, "timebox": {}}
+    tzero._Ctx.response_cache.clear()
+    tzero._Ctx.cache_size = 2
+    tzero._Ctx.default_duration_minutes = 30
+    tzero._Ctx.duration_multiple_minutes = 5
+    tzero._Ctx.min_duration_minutes = 15
+    tzero._Ctx.max_duration_minutes = 60
+
+    first = tzero._run_command(",", "alice", "running", [], "#t0", private=False)
+    assert first == ["No running timeboxes found in #t0."]
+    assert tzero._run_command(",", "bob", "running", [], "#t0", private=False) is first
+
+    tzero._run_command(",", "alice", "begin", ["Read"], "#t0", private=False)
+    second = tzero._run_command(",", "alice", "running", [], "#t0", private=False)
+    assert second is not first
+    assert second[0] == "Timeboxes currently running in #t0:"
+
+    tzero._run_command(",", "alice", "mine", [], "#t0", private=False)
+    tzero._run_command(",", "alice", "list", [], "#t0", private=False)
+    assert len(tzero._Ctx.response_cache) == tzero._Ctx.cache_size
+    assert ("running", "#t0", "", False) not in tzero._Ctx.response_cache
+
+
+class _FakeSocket:
+    def __init__(self) -> None:
+        self.sent: list[bytes] = []
+        self.closed = False
+
+    def sendall(self, data: bytes) -> None:
+        self.sent.append(data)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_allow_message() -> None:
+    """Test _allow_message() rate limiting."""
+    sock = _FakeSocket()
+    tzero._Ctx.user_buckets.clear()
+    tzero._Ctx.channel_buckets.clear()
+    tzero._Ctx.user_burst = 2
+    tzero._Ctx.user_refill_seconds = 3600
+    tzero._Ctx.channel_burst = 3
+    tzero._Ctx.channel_refill_seconds = 3600
+    tzero._Ctx.max_buckets = 2
+    now = [1000.0]
+    tzero._Ctx.monotonic = lambda: now[0]
+    try:
+        assert tzero._allow_message(sock, "alice", "#t0", private=False)  # type: ignore[arg-type]
+        assert tzero._allow_message(sock, "alice", "#t0", private=False)  # type: ignore[arg-type]
+        assert not tzero._allow_message(sock, "alice", "#t0", private=False)  # type: ignore[arg-type]
+        assert not tzero._allow_message(sock, "alice", "#t0", private=False)  # type: ignore[arg-type]
+        assert len(sock.sent) == 1
+        assert sock.sent[0].startswith(b"PRIVMSG #t0 :Warning: alice")
+
+        assert tzero._allow_message(sock, "bob", "#t0", private=False)  # type: ignore[arg-type]
+        assert not tzero._allow_message(sock, "carol", "#t0", private=False)  # type: ignore[arg-type]
+        assert tzero._allow_message(sock, "carol", "carol", private=True)  # type: ignore[arg-type]
+        assert list(tzero._Ctx.user_buckets) == ["bob", "carol"]
+
+        now[0] += 3600
+        assert tzero._allow_message(sock, "carol", "#t0", private=False)  # type: ignore[arg-type]
+    finally:
+        tzero._Ctx.monotonic = tzero.time.monotonic
+
+
+def test_complete_timeboxes_clock() -> None:
+    """Test _complete_timeboxes() with an injected clock."""
+    sock = _FakeSocket()
+    now = [1000.0]
+    tzero._Ctx.clock = lambda: now[0]
+    tzero._Ctx.dev_mode = False
+    tzero._Ctx.state = {"count": 0, "minutes": 0, "timebox": {}}
+    timebox = {
+        "audience": "#t0",
+        "start": 1000,
+        "duration": 15,
+        "summary": "Read",
+        "state": tzero._TState.RUNNING,
+    }
+    tzero._Ctx.state["timebox"] = {"#t0": {"alice": [timebox]}}
+    try:
+        now[0] = 1000 + 15 * 60 - 1
+        tzero._complete_timeboxes(sock)  # type: ignore[arg-type]
+        assert sock.sent == []
+        now[0] += 1
+        tzero._complete_timeboxes(sock)  # type: ignore[arg-type]
+        assert timebox["state"] == tzero._TState.COMPLETED
+        assert sock.sent[0].startswith(b"PRIVMSG #t0 :Completed timebox in #t0:")
+        assert tzero._Ctx.state["count"] == 1
+    finally:
+        tzero._Ctx.clock = tzero.time.time
+
+
+def test_parse_line_tags() -> None:
+    """Test _parse_line() with IRCv3 message tags."""
+    line = "@time=2024-07-02T20:07:00.000Z :alice!Alice@user/alice PRIVMSG #t0 :,list"
+    assert tzero._parse_line(line) == ("alice", "PRIVMSG", "#t0", ",list")
+    assert tzero._parse_line("PING :foo") == (None, "PING", "", "foo")
+
+
+def test_cap_negotiation() -> None:
+    """Test _handle_cap() and _send_batch()."""
+    sock = _FakeSocket()
+    available: dict[str, str] = {}
+    tzero._Ctx.caps = {}
+    tzero._Ctx.sasl = False
+    tzero._Ctx.batch_id = 0
+    tzero._Ctx.sleep = lambda _: None
+    try:
+        tzero._handle_cap(sock, "* LS", "batch draft/multiline", {})  # type: ignore[arg-type]
+        assert sock.sent == [b"CAP REQ :batch\r\n"]
+
+        sock.sent.clear()
+        tzero._handle_cap(sock, "* LS *", "sasl batch message-tags", available)  # type: ignore[arg-type]
+        tzero._handle_cap(
+            sock,  # type: ignore[arg-type]
+            "* LS",
+            "draft/multiline=max-bytes=800,max-lines=3",
+            available,
+        )
+        assert sock.sent == [b"CAP REQ :message-tags batch draft/multiline\r\n"]
+        tzero._handle_cap(
+            sock,  # type: ignore[arg-type]
+            "t0 ACK",
+            "message-tags batch draft/multiline",
+            available,
+        )
+        assert sock.sent[-1] == b"CAP END\r\n"
+        assert tzero._multiline_limits() == (800, 3)
+
+        sock.sent.clear()
+        tzero._send_batch(sock, "#t0", ["a" * 10, "b" * 450, "c" * 850])  # type: ignore[arg-type]
+        assert sock.sent == [
+            b"BATCH +tzero1 draft/multiline #t0\r\n",
+            b"@batch=tzero1 PRIVMSG #t0 :" + b"a" * 10 + b"\r\n",
+            b"@batch=tzero1 PRIVMSG #t0 :" + b"b" * 400 + b"\r\n",
+            b"@batch=tzero1;draft/multiline-concat PRIVMSG #t0 :" + b"b" * 50 + b"\r\n",
+            b"BATCH -tzero1\r\n",
+            b"PRIVMSG #t0 :" + b"c" * 400 + b"\r\n",
+            b"BATCH +tzero2 draft/multiline #t0\r\n",
+            b"@batch=tzero2 PRIVMSG #t0 :" + b"c" * 400 + b"\r\n",
+            b"@batch=tzero2;draft/multiline-concat PRIVMSG #t0 :" + b"c" * 50 + b"\r\n",
+            b"BATCH -tzero2\r\n",
+        ]
+
+        sock.sent.clear()
+        tzero._handle_cap(sock, "t0 DEL", "message-tags", available)  # type: ignore[arg-type]
+        assert "message-tags" not in tzero._Ctx.caps
+        assert tzero._multiline_limits() is None
+        assert sock.sent == []
+    finally:
+        tzero._Ctx.caps = {}
+        tzero._Ctx.sleep = tzero.time.sleep
+
+
+def test_blocklist() -> None:
+    """Test _Blocklist matching."""
+    blocklist = tzero._Blocklist(["xxx"], ["he", "she", "hers", "his"])
+    assert blocklist.match(["read", "XXX"])
+    assert not blocklist.match(["read", "xxxx"])
+    assert blocklist.match(["USHERS"])
+    assert blocklist.match(["a", "this"])
+    assert not blocklist.match(["a", "hi", "s"])
+    assert not tzero._Blocklist([], []).match(["anything"])
+    assert tzero._Blocklist([], ["d a"]).match(["read", "a", "book"])
+
+
+def test_reload_blocklist(
+    tmp_path: pathlib.Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    """Test _reload_blocklist() when the blocklist file goes bad."""
+    path = tmp_path / "blocklist.txt"
+    path.write_text("xxx\n")
+    tzero._Ctx.block_words = []
+    tzero._Ctx.block_file = str(path)
+    tzero._Ctx.block_file_failed = False
+    try:
+        tzero._load_blocklist()
+        path.unlink()
+        tzero._reload_blocklist()
+        tzero._reload_blocklist()
+        errors = [r for r in caplog.records if r.levelname == "ERROR"]
+        assert len(errors) == 1
+        assert errors[0].exc_info is None
+        assert tzero._Ctx.blocklist is not None
+        assert tzero._Ctx.blocklist.match(["xxx"])
+
+        path.write_text("yyyy\n")
+        tzero._reload_blocklist()
+        assert not tzero._Ctx.block_file_failed
+        assert tzero._Ctx.blocklist.match(["yyyy"])
+
+        caplog.clear()
+        path.write_bytes(b"\xff\xfe\n")
+        tzero._reload_blocklist()
+        tzero._reload_blocklist()
+        errors = [r for r in caplog.records if r.levelname == "ERROR"]
+        assert len(errors) == 1
+        assert tzero._Ctx.blocklist.match(["yyyy"])
+    finally:
+        tzero._Ctx.block_file = ""
+        tzero._Ctx.blocklist = None
+
+
+def test_probe_liveness() -> None:
+    """Test _probe_liveness() pings, resets and timeouts."""
+    sock = _FakeSocket()
+    tzero._Ctx.ping_interval_seconds = 120
+    tzero._Ctx.pong_timeout_seconds = 30
+    tzero._Ctx.last_recv_time = 1000.0
+    tzero._Ctx.ping_time = 0.0
+
+    tzero._probe_liveness(sock, 1119.0, received=False)  # type: ignore[arg-type]
+    assert sock.sent == []
+    tzero._probe_liveness(sock, 1120.0, received=False)  # type: ignore[arg-type]
+    assert sock.sent == [b"PING :tzero\r\n"]
+    tzero._probe_liveness(sock, 1130.0, received=False)  # type: ignore[arg-type]
+    assert sock.sent == [b"PING :tzero\r\n"]
+
+    tzero._probe_liveness(sock, 1140.0, received=True)  # type: ignore[arg-type]
+    assert tzero._Ctx.ping_time == 0
+    tzero._probe_liveness(sock, 1200.0, received=False)  # type: ignore[arg-type]
+    assert sock.sent == [b"PING :tzero\r\n"]
+    assert not sock.closed
+
+    tzero._probe_liveness(sock, 1260.0, received=False)  # type: ignore[arg-type]
+    assert sock.sent == [b"PING :tzero\r\n"] * 2
+    with pytest.raises(tzero._DeadConnectionError):
+        tzero._probe_liveness(sock, 1290.0, received=False)  # type: ignore[arg-type]
+    assert sock.closed
+
+
+def test_api_query() -> None:
+    """Test _api_query()."""
+    tzero._Ctx.state = {"count": 2, "minutes": 45, "timebox": {}}
+    tzero._Ctx.state["timebox"]["#t0"] = {
+        "alice": [
+            {"audience": "#t0", "start": 10, "duration": 15, "summary": "A"},
+            {"audience": "#t0", "start": 30, "duration": 30, "summary": "B"},
+        ],
+        "bob": [{"audience": "#t0", "start": 20, "duration": 30, "summary": "C"}],
+    }
+    for timeboxes in tzero._Ctx.state["timebox"]["#t0"].values():
+        for timebox in timeboxes:
+            timebox["state"] = tzero._TState.COMPLETED
+    tzero._Ctx.state["timebox"]["#t0"]["bob"][-1]["state"] = tzero._TState.RUNNING
+
+    status, result = tzero._api_query("/list", {"channel": "#t0", "limit": "1"})
+    assert status == http.HTTPStatus.OK
+    assert result["total"] == len(tzero._Ctx.state["timebox"]["#t0"]["alice"])
+    assert [t["summary"] for t in result["timeboxes"]] == ["B"]
+
+    _, result = tzero._api_query("/list", {"channel": "#t0", "offset": "1"})
+    assert [t["summary"] for t in result["timeboxes"]] == ["A"]
+
+    _, result = tzero._api_query("/running", {"channel": "#t0"})
+    assert result["timeboxes"][0]["person"] == "bob"
+    assert "audience" not in result["timeboxes"][0]
+
+    _, result = tzero._api_query("/mine", {"channel": "#t0", "person": "bob"})
+    assert result["total"] == 0
+
+    assert tzero._api_query("/summary", {})[1]["average"] == round(45 / 2)
+    assert tzero._api_query("/list", {})[0] == http.HTTPStatus.BAD_REQUEST
+    status, result = tzero._api_query("/list", {"channel": "#t0", "limit": "x"})
+    assert status == http.HTTPStatus.BAD_REQUEST
+    status, result = tzero._api_query("/list", {"channel": "#t0", "offset": "-1"})
+    assert status == http.HTTPStatus.BAD_REQUEST
+    assert result["error"] == "Offset must not be negative"
+    assert tzero._api_query("/foo", {})[0] == http.HTTPStatus.NOT_FOUND
+
+
+def test_schedule_joins() -> None:
+    """Test _schedule_joins() and _join_result()."""
+    sock = _FakeSocket()
+    channels = [f"#{c * 100}" for c in "abcdefghij"]
+    tzero._Ctx.join_bucket.clear()
+    tzero._Ctx.join_burst = 2
+    tzero._Ctx.join_refill_seconds = 3600
+    tzero._Ctx.join_retry_seconds = 0
+    tzero._Ctx.joins = {
+        c: {"name": c, "state": "pending", "time": 0.0, "attempts": 0} for c in channels
+    }
+
+    tzero._schedule_joins(sock)  # type: ignore[arg-type]
+    assert sock.sent == [
+        ("JOIN " + ",".join(channels[:4]) + "\r\n").encode(),
+        ("JOIN " + ",".join(channels[4:8]) + "\r\n").encode(),
+    ]
+    assert tzero._Ctx.joins[channels[8]]["state"] == "pending"
+
+    tzero._join_result(channels[0].upper(), None)
+    tzero._join_result(channels[1], "474 Cannot join channel (+b)")
+    tzero._join_result(channels[2], "405 Too many channels", retry=False)
+    assert tzero._Ctx.joins[channels[0]]["state"] == "joined"
+    assert tzero._Ctx.joins[channels[1]]["state"] == "failed"
+    assert tzero._Ctx.joins[channels[2]]["state"] == "abandoned"
+
+    tzero._Ctx.join_burst = 0
+    sock.sent.clear()
+    tzero._schedule_joins(sock)  # type: ignore[arg-type]
+    assert sock.sent == [f"JOIN {channels[1]},{channels[8]},{channels[9]}\r\n".encode()]
+    assert tzero._irc_lower("#Foo[]\\^") == "#foo{}|~"
+
+
+def test_join_retry() -> None:
+    """Test join timeouts and retry backoff with an injected clock."""
+    sock = _FakeSocket()
+    now = [1000.0]
+    tzero._Ctx.monotonic = lambda: now[0]
+    tzero._Ctx.join_burst = 0
+    tzero._Ctx.join_retry_seconds = 10
+    tzero._Ctx.join_timeout_seconds = 60
+    tzero._Ctx.joins = {
+        "#a": {"name": "#a", "state": "pending", "time": 0.0, "attempts": 0}
+    }
+    join = tzero._Ctx.joins["#a"]
+    try:
+        tzero._schedule_joins(sock)  # type: ignore[arg-type]
+        assert sock.sent == [b"JOIN #a\r\n"]
+
+        # No reply within the timeout: retry after join_retry_seconds.
+        now[0] = 1059.0
+        tzero._schedule_joins(sock)  # type: ignore[arg-type]
+        assert join["state"] == "sent"
+        now[0] = 1060.0
+        tzero._schedule_joins(sock)  # type: ignore[arg-type]
+        assert join["state"] == "failed"
+        assert join["time"] == now[0] + tzero._Ctx.join_retry_seconds
+        now[0] = join["time"]
+        tzero._schedule_joins(sock)  # type: ignore[arg-type]
+        assert sock.sent == [b"JOIN #a\r\n"] * 2
+
+        # The wait doubles after each failed attempt up to one hour.
+        tzero._join_result("#A", "471 Cannot join channel (+l)")
+        assert join["time"] == now[0] + tzero._Ctx.join_retry_seconds * 2
+        now[0] = join["time"] - 1
+        tzero._schedule_joins(sock)  # type: ignore[arg-type]
+        assert sock.sent == [b"JOIN #a\r\n"] * 2
+        join["attempts"] = 20
+        tzero._join_result("#a", "471 Cannot join channel (+l)")
+        assert join["time"] == now[0] + 3600
+    finally:
+        tzero._Ctx.monotonic = tzero.time.monotonic
+
+
+def test_capture(tmp_path: pathlib.Path) -> None:
+    """Test _capture() rotation and _read_capture()."""
+    capture_file = tmp_path / "tzero.cap"
+    tzero._Ctx.state = {"count": 0, "minutes": 0, "timebox": {}}
+    tzero._Ctx.capture_file = str(capture_file)
+    tzero._Ctx.capture_max_bytes = 100
+    tzero._Ctx.capture_backups = 1
+    tzero._open_capture()
+    try:
+        tzero._capture(b"<", b"PING :\xff\xfe")
+        tzero._capture(b">", b"PONG :foo" * 10)
+        tzero._capture(b"<", b"PING :bar")
+    finally:
+        assert tzero._Ctx.capture_stream is not None
+        tzero._Ctx.capture_stream.close()
+        tzero._Ctx.capture_stream = None
+
+    old = tzero._read_capture(f"{capture_file}.1")
+    new = tzero._read_capture(str(capture_file))
+    snapshot = b'{"count": 0, "minutes": 0, "timebox": {}}'
+    assert [(kind, data) for _, kind, data in old] == [
+        (b"S", snapshot),
+        (b"<", b"PING :\xff\xfe"),
+        (b">", b"PONG :foo" * 10),
+        (b"S", snapshot),
+    ]
+    assert [kind for _, kind, _ in new] == [b"S", b"<"]
+    assert new[1][2] == b"PING :bar"
+
+
+def _record_session(
+    listener: socket.socket, script: list[tuple[int, bytes]], now: list[float]
+) -> None:
+    # Before each line, move the clock and wait for the client to answer
+    # a PING, so that the client runs its periodic tasks at that time.
+    conn, _ = listener.accept()
+    buffer = b""
+    with conn:
+        for i, (seconds, line) in enumerate([*script, (0, b"")]):
+            now[0] += seconds
+            token = f"tick-{i}".encode()
+            conn.sendall(b"PING :" + token + b"\r\n")
+            while b"PONG :" + token + b"\r\n" not in buffer:
+                buffer += conn.recv(65536)
+            if line:
+                conn.sendall(line + b"\r\n")
+
+
+def test_replay_round_trip(
+    tmp_path: pathlib.Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test that replaying a recorded session reproduces it exactly."""
+    config_file = pathlib.Path(__file__).parent / "etc" / "tzero.json"
+    config = json.loads(config_file.read_text())
+    config.update(
+        {
+            "nick": "t0",
+            "password": "secret",
+            "capture": str(tmp_path / "tzero.cap"),
+            "capture_max_bytes": 800,
+            "capture_backups": 20,
+            "ping_interval_seconds": 0,
+            "join_burst": 0,
+        }
+    )
+    script = [
+        (0, b":srv 001 t0 :Welcome"),
+        (0, b":t0!t0@host JOIN #t0"),
+        (10, b":alice!a@host PRIVMSG #t0 :,begin 15 Read"),
+        (60, b":bob!b@host PRIVMSG #t0 :,begin 20 Write"),
+        (600, b":alice!a@host PRIVMSG #t0 :,running"),
+        (600, b":carol!c@host PRIVMSG t0 :,begin 15 Plan"),
+        (1200, b":bob!b@host PRIVMSG #t0 :,mine"),
+        (0, b":alice!a@host PRIVMSG #t0 :,list"),
+    ]
+
+    now = [1_700_000_000.0]
+
+    def sleep(seconds: float) -> None:
+        now[0] += seconds
+
+    tzero._configure(config)
+    tzero._Ctx.clock = lambda: now[0]
+    tzero._Ctx.monotonic = lambda: now[0]
+    tzero._Ctx.sleep = sleep
+    tzero._Ctx.state = {"count": 0, "minutes": 0, "timebox": {}}
+    tzero._Ctx.response_cache.clear()
+    tzero._Ctx.user_buckets.clear()
+    tzero._Ctx.channel_buckets.clear()
+    tzero._Ctx.join_bucket.clear()
+    try:
+        tzero._open_capture()
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            server = threading.Thread(
+                target=_record_session, args=(listener, script, now), daemon=True
+            )
+            server.start()
+            with pytest.raises(ValueError, match="zero-length"):
+                tzero._run(
+                    host="127.0.0.1",
+                    port=listener.getsockname()[1],
+                    tls=False,
+                    nick=config["nick"],
+                    password=config["password"],
+                    channels=config["channels"],
+                    prefix=config["prefix"],
+                    nimb_nick=config["nimb"],
+                    state_filename=str(tmp_path / "state.json"),
+                )
+            server.join()
+        assert tzero._Ctx.capture_stream is not None
+        tzero._Ctx.capture_stream.close()
+        tzero._Ctx.capture_stream = None
+
+        backups = sorted(tmp_path.glob("tzero.cap.*"), key=lambda x: -int(x.suffix[1:]))
+        filenames = [str(f) for f in [*backups, tmp_path / "tzero.cap"]]
+        assert len(backups) > 1
+        capsys.readouterr()
+        tzero._Ctx.response_cache.clear()
+        tzero._Ctx.user_buckets.clear()
+        tzero._Ctx.channel_buckets.clear()
+        tzero._Ctx.join_bucket.clear()
+        tzero._replay(config, filenames, None)
+    finally:
+        tzero._Ctx.clock = tzero.time.time
+        tzero._Ctx.monotonic = tzero.time.monotonic
+        tzero._Ctx.sleep = tzero.time.sleep
+        tzero._Ctx.capture_file = ""
+        tzero._LOG.setLevel(logging.NOTSET)
+
+    report = dict(line.split() for line in capsys.readouterr().out.splitlines())
+    assert int(report["replies_original"]) > 0
+    assert report["replies_matched"] == report["replies_original"]
+    assert report["replies_missing"] == report["replies_extra"] == "0"
+    assert int(report["state_checkpoints"]) > 0
+    assert report["state_diverged"] == "0"
+
+
+def test_parse_speed() -> None:
+    """Test _parse_speed() used by the replay command."""
+    assert tzero._parse_speed("max") is None
+    assert tzero._parse_speed("0.5") == 1 / 2
+    for value in ("0", "-1", "x", "nan", "inf"):
+        with pytest.raises(tzero.argparse.ArgumentTypeError):
+            tzero._parse_speed(value)
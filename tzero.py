@@ -4,7 +4,12 @@
 
 from __future__ import annotations
 
+import argparse
+import base64
+import collections
 import enum
+import functools
+import http.server
 import json
 import logging
 import pathlib
@@ -12,8 +17,14 @@ import re
 import select
 import socket
 import ssl
+import statistics
+import struct
+import sys
+import tempfile
+import threading
 import time
-from typing import Any, ClassVar, Iterator
+import urllib.parse
+from typing import Any, BinaryIO, Callable, ClassVar, Iterator
 
 _NAME = "tzero"
 _VER = "0.3.0.dev2"
@@ -23,6 +34,9 @@ _LOG = logging.getLogger(_NAME)
 class _Ctx:
     dev_mode: bool = False
     retry_delay: ClassVar[int] = 1
+    clock: ClassVar[Callable[[], float]] = time.time
+    monotonic: ClassVar[Callable[[], float]] = time.monotonic
+    sleep: ClassVar[Callable[[float], None]] = time.sleep
     state: ClassVar[dict[str, Any]] = {
         "count": 0,
         "minutes": 0,
@@ -40,6 +54,61 @@ class _Ctx:
         "help",
         "version",
     ]
+    cached_commands: ClassVar[list[str]] = [
+        "list",
+        "mine",
+        "running",
+    ]
+    versions: ClassVar[dict[str, int]] = {}
+    response_cache: ClassVar[
+        collections.OrderedDict[tuple[str, str, str, bool], tuple[int, list[str]]]
+    ] = collections.OrderedDict()
+    cache_size: int = 0
+    user_buckets: ClassVar[collections.OrderedDict[str, dict[str, Any]]] = (
+        collections.OrderedDict()
+    )
+    channel_buckets: ClassVar[collections.OrderedDict[str, dict[str, Any]]] = (
+        collections.OrderedDict()
+    )
+    user_burst: int = 0
+    user_refill_seconds: float = 0
+    channel_burst: int = 0
+    channel_refill_seconds: float = 0
+    max_buckets: int = 0
+    wanted_caps: ClassVar[list[str]] = [
+        "sasl",
+        "message-tags",
+        "server-time",
+        "batch",
+        "draft/multiline",
+    ]
+    caps: ClassVar[dict[str, str]] = {}
+    sasl: bool = False
+    batch_id: int = 0
+    joins: ClassVar[dict[str, dict[str, Any]]] = {}
+    join_bucket: ClassVar[collections.OrderedDict[str, dict[str, Any]]] = (
+        collections.OrderedDict()
+    )
+    join_burst: int = 0
+    join_refill_seconds: float = 0
+    join_retry_seconds: int = 0
+    join_timeout_seconds: ClassVar[int] = 60
+    lock: ClassVar[threading.Lock] = threading.Lock()
+    api_port: int = 0
+    capture_file: str = ""
+    capture_max_bytes: int = 0
+    capture_backups: int = 0
+    capture_stream: ClassVar[BinaryIO | None] = None
+    api_max_limit: ClassVar[int] = 1000
+    ping_interval_seconds: int = 0
+    pong_timeout_seconds: int = 0
+    last_recv_time: float = 0.0
+    ping_time: float = 0.0
+    block_words: ClassVar[list[str]] = []
+    block_file: str = ""
+    block_file_stat: ClassVar[tuple[int, int]] = (0, 0)
+    block_file_failed: bool = False
+    blocklist: ClassVar[_Blocklist | None] = None
     keep_timeboxes: int = 0
     keep_duration_seconds: int = 0
     max_print_channel: int = 0
@@ -55,6 +124,65 @@ class _TState(enum.StrEnum):
     COMPLETED = enum.auto()
 
 
+class _DeadConnectionError(Exception):
+    """Server did not answer a liveness probe in time."""
+
+
+class _Blocklist:
+    """Case-insensitive matcher for blocked words and substrings.
+
+    Blocked words are matched against whole parameters with a set
+    lookup.  Blocked substrings are matched anywhere in the parameters
+    with an Aho-Corasick automaton, so the cost of a match depends on
+    the length of the parameters, not on the size of the blocklist.
+    """
+
+    def __init__(self, words: list[str], substrings: list[str]) -> None:
+        self.words = {word.casefold() for word in words}
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.out: list[bool] = [False]
+
+        # Build a trie of the substrings.
+        for substring in substrings:
+            state = 0
+            for char in substring.casefold():
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(False)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            if state != 0:
+                self.out[state] = True
+
+        # Compute failure links in breadth-first order.
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail != 0 and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.out[next_state] |= self.out[self.fail[next_state]]
+
+    def match(self, params: list[str]) -> bool:
+        if any(param.casefold() in self.words for param in params):
+            return True
+        if len(self.goto) == 1:
+            return False
+        state = 0
+        for char in " ".join(params).casefold():
+            while state != 0 and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.out[state]:
+                return True
+        return False
+
+
 def main() -> None:
     """Run this tool."""
     log_fmt = (
@@ -64,26 +192,45 @@ def main() -> None:
     log_level = logging.DEBUG if _Ctx.dev_mode else logging.INFO
     logging.basicConfig(format=log_fmt, level=log_level)
 
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(prog=_NAME, description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    replay_parser = subparsers.add_parser(
+        "replay", help="replay captured traffic against a local fake server"
+    )
+    replay_parser.add_argument(
+        "--speed",
+        type=_parse_speed,
+        default=1.0,
+        help="speed-up factor greater than 0 or 'max' (default: 1)",
+    )
+    replay_parser.add_argument("capture", nargs="+", help="capture files, oldest first")
+    args = parser.parse_args()
+
     # Read configuration.
     with pathlib.Path(f"{_NAME}.json").open() as stream:
         config = json.load(stream)
 
     # Update context.
-    _Ctx.dev_mode = config.get("dev_mode", False)
-    _Ctx.keep_timeboxes = config["keep_timeboxes"]
-    _Ctx.keep_duration_seconds = config["keep_duration_seconds"]
-    _Ctx.max_print_channel = config["max_print_channel"]
-    _Ctx.max_print_private = config["max_print_private"]
-    _Ctx.default_duration_minutes = config["default_duration_minutes"]
-    _Ctx.duration_multiple_minutes = config["duration_multiple_minutes"]
-    _Ctx.min_duration_minutes = config["min_duration_minutes"]
-    _Ctx.max_duration_minutes = config["max_duration_minutes"]
+    _configure(config)
+
+    if args.command == "replay":
+        _replay(config, args.capture, args.speed)
+        return
 
     # Ensure we can write to state file.
     _read_state(config["state"])
     _clean_state()
     _write_state(config["state"])
 
+    # Record traffic.
+    if _Ctx.capture_file:
+        _open_capture()
+
+    # Serve local queries.
+    if _Ctx.api_port > 0:
+        _start_api(_Ctx.api_port)
+
     # Run application forever.
     while True:
         try:
@@ -96,16 +243,49 @@ def main() -> None:
                 config["channels"],
                 config["prefix"],
                 config["nimb"],
-                config["block"],
                 config["state"],
             )
-        except Exception:  # noqa: PERF203, BLE001 (try-except-in-loop, blind-except)
+        except _DeadConnectionError as e:  # noqa: PERF203 (try-except-in-loop)
+            _LOG.error("Client lost connection: %s", e)
+            _LOG.info("Reconnecting now")
+        except Exception:  # noqa: BLE001 (blind-except)
             _LOG.exception("Client encountered error")
             _LOG.info("Reconnecting in %d s", _Ctx.retry_delay)
             time.sleep(_Ctx.retry_delay)
             _Ctx.retry_delay = min(_Ctx.retry_delay * 2, 3600)
 
 
+def _configure(config: dict[str, Any]) -> None:
+    _Ctx.dev_mode = config.get("dev_mode", False)
+    _Ctx.sasl = config.get("sasl", False)
+    _Ctx.api_port = config.get("api_port", 0)
+    _Ctx.capture_file = config.get("capture", "")
+    _Ctx.capture_max_bytes = config.get("capture_max_bytes", 10485760)
+    _Ctx.capture_backups = config.get("capture_backups", 5)
+    _Ctx.join_burst = config.get("join_burst", 4)
+    _Ctx.join_refill_seconds = config.get("join_refill_seconds", 2)
+    _Ctx.join_retry_seconds = config.get("join_retry_seconds", 300)
+    _Ctx.ping_interval_seconds = config.get("ping_interval_seconds", 120)
+    _Ctx.pong_timeout_seconds = config.get("pong_timeout_seconds", 30)
+    _Ctx.keep_timeboxes = config["keep_timeboxes"]
+    _Ctx.keep_duration_seconds = config["keep_duration_seconds"]
+    _Ctx.max_print_channel = config["max_print_channel"]
+    _Ctx.max_print_private = config["max_print_private"]
+    _Ctx.default_duration_minutes = config["default_duration_minutes"]
+    _Ctx.duration_multiple_minutes = config["duration_multiple_minutes"]
+    _Ctx.min_duration_minutes = config["min_duration_minutes"]
+    _Ctx.max_duration_minutes = config["max_duration_minutes"]
+    _Ctx.cache_size = config.get("cache_size", 256)
+    _Ctx.user_burst = config.get("user_burst", 5)
+    _Ctx.user_refill_seconds = config.get("user_refill_seconds", 10)
+    _Ctx.channel_burst = config.get("channel_burst", 20)
+    _Ctx.channel_refill_seconds = config.get("channel_refill_seconds", 2)
+    _Ctx.max_buckets = config.get("max_buckets", 1024)
+    _Ctx.block_words = config["block"]
+    _Ctx.block_file = config.get("block_file", "")
+    _load_blocklist()
+
+
 def _run(
     host: str,
     port: int,
@@ -115,31 +295,64 @@ def _run(
     channels: list[str],
     prefix: str,  # e.g., ","
     nimb_nick: str,
-    blocked_words: list[str],
     state_filename: str,
 ) -> None:
     _LOG.info("Connecting ...")
     sock = socket.create_connection((host, port))
+    _set_keepalive(sock)
     if tls:
         tls_context = ssl.create_default_context()
         sock = tls_context.wrap_socket(sock, server_hostname=host)
 
+    # Servers that do not support IRCv3 capability negotiation reply
+    # to CAP with an error and carry on with plain registration.
     _LOG.info("Authenticating ...")
+    _Ctx.caps = {}
+    _Ctx.joins = {}
+    available_caps: dict[str, str] = {}
+    _send(sock, "CAP LS 302")
     _send(sock, f"PASS {password}")
     _send(sock, f"NICK {nick}")
     _send(sock, f"USER {nick} {nick} {host} :{nick}")
 
-    _LOG.info("Joining channels ...")
-    for channel in channels:
-        _send(sock, f"JOIN {channel}")
-
     _LOG.info("Receiving messages ...")
+    _Ctx.last_recv_time = time.monotonic()
+    _Ctx.ping_time = 0.0
     for line in _recv(sock):
+        _probe_liveness(sock, time.monotonic(), received=line is not None)
         if line is not None:
             sender, command, middle, trailing = _parse_line(line)
             if command == "PING":
                 _send(sock, f"PONG :{trailing}")
                 _Ctx.retry_delay = 1
+            elif command in _REGISTRATION_COMMANDS:
+                _handle_registration(
+                    sock,
+                    nick,
+                    password,
+                    channels,
+                    command,
+                    middle,
+                    trailing,
+                    available_caps,
+                )
+            elif command == "JOIN" and sender == nick:
+                _join_result(trailing or middle or "", None)
+            elif command in (
+                "403",  # ERR_NOSUCHCHANNEL
+                "405",  # ERR_TOOMANYCHANNELS
+                "437",  # ERR_UNAVAILRESOURCE
+                "471",  # ERR_CHANNELISFULL
+                "473",  # ERR_INVITEONLYCHAN
+                "474",  # ERR_BANNEDFROMCHAN
+                "475",  # ERR_BADCHANNELKEY
+                "477",  # ERR_NEEDREGGEDNICK
+            ):
+                params = (middle or "").split()
+                if len(params) > 1:
+                    _join_result(
+                        params[1], f"{command} {trailing}", retry=command != "405"
+                    )
             elif command == "PRIVMSG":
                 _LOG.info(
                     "sender: %s; command: %s; middle: %s; trailing: %s",
@@ -155,7 +368,6 @@ def _run(
                             nick,
                             prefix,
                             nimb_nick,
-                            blocked_words,
                             sender,
                             middle,
                             trailing,
@@ -164,19 +376,81 @@ def _run(
                     except Exception:  # noqa: BLE001 (blind-except)
                         _LOG.exception("Command processor encountered error")
         try:
-            _complete_timeboxes(sock)
-            _clean_state()
+            _schedule_joins(sock)
+            with _Ctx.lock:
+                _complete_timeboxes(sock)
+                _clean_state()
             _write_state(state_filename)
         except Exception:  # noqa: BLE001 (blind-except)
             _LOG.exception("Task processor encountered error")
 
 
+def _probe_liveness(sock: socket.socket, now: float, received: bool) -> None:
+    # Any line received from the server proves that the connection is
+    # alive.  After a period of silence, send our own PING and give up
+    # on the connection if nothing arrives before the deadline.
+    if received:
+        _Ctx.last_recv_time = now
+        _Ctx.ping_time = 0.0
+        return
+    if _Ctx.ping_interval_seconds <= 0:
+        return
+    if _Ctx.ping_time == 0:
+        if now - _Ctx.last_recv_time >= _Ctx.ping_interval_seconds:
+            _send(sock, f"PING :{_NAME}")
+            _Ctx.ping_time = now
+    elif now - _Ctx.ping_time >= _Ctx.pong_timeout_seconds:
+        message = f"No reply to PING in {_Ctx.pong_timeout_seconds} s"
+        _LOG.error(message)
+        sock.close()
+        raise _DeadConnectionError(message)
+
+
+_REGISTRATION_COMMANDS = (
+    "CAP",
+    "AUTHENTICATE",
+    "001",  # RPL_WELCOME
+    "902",  # ERR_NICKLOCKED
+    "903",  # RPL_SASLSUCCESS
+    "904",  # ERR_SASLFAIL
+    "905",  # ERR_SASLTOOLONG
+    "906",  # ERR_SASLABORTED
+    "907",  # ERR_SASLALREADY
+)
+
+
+def _handle_registration(
+    sock: socket.socket,
+    nick: str,
+    password: str,
+    channels: list[str],
+    command: str,
+    middle: str | None,
+    trailing: str | None,
+    available_caps: dict[str, str],
+) -> None:
+    if command == "CAP":
+        _handle_cap(sock, middle, trailing, available_caps)
+    elif command == "AUTHENTICATE":
+        if middle == "+":
+            _send_sasl_plain(sock, nick, password)
+    elif command == "001":
+        _LOG.info("Joining channels ...")
+        _Ctx.joins = {
+            _irc_lower(c): {"name": c, "state": "pending", "time": 0.0, "attempts": 0}
+            for c in channels
+        }
+    else:
+        if command != "903":
+            _LOG.error("SASL authentication failed: %s", trailing)
+        _send(sock, "CAP END")
+
+
 def _try_process_message(
     sock: socket.socket,
     nick: str,
     prefix: str,  # e.g., ","
     nimb_nick: str,
-    blocked_words: list[str],
     sender: str,
     recipient: str,
     message: str,
@@ -209,10 +483,11 @@ def _try_process_message(
         message = matches.group(2)
 
     if message.startswith(prefix):
+        if not _allow_message(sock, sender, recipient, private):
+            return
         _process_message(
             sock,
             prefix,
-            blocked_words,
             sender,
             recipient,
             private,
@@ -223,7 +498,6 @@ def _try_process_message(
 def _process_message(
     sock: socket.socket,
     prefix: str,  # e.g., ","
-    blocked_words: list[str],
     sender: str,
     recipient: str,
     private: bool,
@@ -258,19 +532,98 @@ def _process_message(
 
     command = matches[0]
 
-    if any(word in params for word in blocked_words):
+    _reload_blocklist()
+    if _Ctx.blocklist is not None and _Ctx.blocklist.match(params):
         msg = "Error: Parameters contain blocked word."
         _send_message(sock, audience, msg)
         return
 
-    command_function = globals()[f"_{command}_command"]
+    with _Ctx.lock:
+        messages = _run_command(prefix, sender, command, params, audience, private)
+    if _multiline_limits() is not None:
+        _send_batch(sock, audience, messages)
+        return
+
     throttle_delay = 0
-    for msg in command_function(prefix, sender, command, params, audience, private):
+    for msg in messages:
         _send_message(sock, audience, msg)
-        time.sleep(throttle_delay)
+        _Ctx.sleep(throttle_delay)
         throttle_delay = 1
 
 
+def _allow_message(
+    sock: socket.socket,
+    sender: str,
+    recipient: str,
+    private: bool,
+) -> bool:
+    now = _Ctx.monotonic()
+    audience = sender if private else recipient
+    user = _refill_bucket(
+        _Ctx.user_buckets, sender, _Ctx.user_burst, _Ctx.user_refill_seconds, now
+    )
+    channel = None
+    if not private:
+        channel = _refill_bucket(
+            _Ctx.channel_buckets,
+            recipient,
+            _Ctx.channel_burst,
+            _Ctx.channel_refill_seconds,
+            now,
+        )
+
+    # Warn a user only once when they exceed their limit.  Further
+    # commands are dropped silently until the bucket refills.
+    if user is not None and user["tokens"] < 1:
+        _LOG.info("Dropping command from %s: user rate limit exceeded", sender)
+        if not user["warned"]:
+            user["warned"] = True
+            msg = (
+                f"Warning: {sender} is sending commands too quickly.  "
+                "Further commands will be ignored for a while."
+            )
+            _send_message(sock, audience, msg)
+        return False
+
+    if channel is not None and channel["tokens"] < 1:
+        _LOG.info("Dropping command in %s: channel rate limit exceeded", recipient)
+        return False
+
+    if user is not None:
+        user["tokens"] -= 1
+        user["warned"] = False
+    if channel is not None:
+        channel["tokens"] -= 1
+    return True
+
+
+def _refill_bucket(
+    buckets: collections.OrderedDict[str, dict[str, Any]],
+    key: str,
+    burst: int,
+    refill_seconds: float,
+    now: float,
+) -> dict[str, Any] | None:
+    if burst <= 0:
+        return None
+
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = {"tokens": burst, "time": now, "warned": False}
+        while len(buckets) > max(_Ctx.max_buckets, 1):
+            buckets.popitem(last=False)
+        return bucket
+
+    buckets.move_to_end(key)
+    if refill_seconds > 0:
+        refill = (now - bucket["time"]) / refill_seconds
+        bucket["tokens"] = min(bucket["tokens"] + refill, burst)
+    else:
+        bucket["tokens"] = burst
+    bucket["time"] = now
+    return bucket
+
+
 # Command begin
 def _begin_command(  # noqa: PLR0911 (too-many-return-statements)
     prefix: str,
@@ -328,13 +681,14 @@ def _begin_command(  # noqa: PLR0911 (too-many-return-statements)
 
     new_timebox = {
         "audience": audience,  # Used for notifying completed timeboxes.
-        "start": int(time.time()),
+        "start": int(_Ctx.clock()),
         "duration": duration,
         "summary": summary,
         "state": _TState.RUNNING,
     }
 
     timeboxes.append(new_timebox)
+    _bump_version(audkey)
     return [f"Started timebox in {audkey}: {_format_timebox(person, new_timebox)}"]
 
 
@@ -375,6 +729,7 @@ def _cancel_command(
 
     cancelled_timebox = timeboxes[-1]
     del timeboxes[-1]
+    _bump_version(audkey)
     return ["Cancelled running timebox: " + _format_timebox(person, cancelled_timebox)]
 
 
@@ -409,6 +764,7 @@ def _delete_command(
 
     deleted_timebox = timeboxes[-1]
     del timeboxes[-1]
+    _bump_version(audkey)
     return [
         "Deleted the last completed timebox: "
         f"{_format_timebox(person, deleted_timebox)}"
@@ -573,7 +929,7 @@ def _time_command(
 ) -> list[str]:
     if len(params) > 0:
         return ["Error: " + _time_help(prefix, command)[0]]
-    return [time.strftime("%Y-%m-%d %H:%M:%S %Z", time.gmtime())]
+    return [time.strftime("%Y-%m-%d %H:%M:%S %Z", time.gmtime(_Ctx.clock()))]
 
 
 def _time_help(prefix: str, command: str) -> list[str]:
@@ -646,7 +1002,7 @@ def _version_help(prefix: str, command: str) -> list[str]:
 
 # Tasks.
 def _complete_timeboxes(sock: socket.socket) -> None:
-    current_time = int(time.time())
+    current_time = int(_Ctx.clock())
     multiplier = 1 if _Ctx.dev_mode else 60
     for audkey, persons in _Ctx.state["timebox"].items():
         for person, timeboxes in persons.items():
@@ -661,11 +1017,12 @@ def _complete_timeboxes(sock: socket.socket) -> None:
                 msg = f"Completed timebox in {audkey}: {_format_timebox(person, last)}"
                 _Ctx.state["count"] += 1
                 _Ctx.state["minutes"] += last["duration"]
+                _bump_version(audkey)
                 _send_message(sock, last["audience"], msg)
 
 
 def _clean_state() -> None:
-    current_time = int(time.time())
+    current_time = int(_Ctx.clock())
     cleaned_timebox_state: dict[str, dict[str, list[dict[str, int | str]]]] = {}
     for audkey, persons in _Ctx.state["timebox"].items():
         for person, timeboxes in persons.items():
@@ -675,6 +1032,8 @@ def _clean_state() -> None:
                 if current_time <= timebox["start"] + _Ctx.keep_duration_seconds
             ]
             cleaned_timeboxes = cleaned_timeboxes[-_Ctx.keep_timeboxes :]
+            if len(cleaned_timeboxes) != len(timeboxes):
+                _bump_version(audkey)
             if len(cleaned_timeboxes) > 0:
                 if audkey not in cleaned_timebox_state:
                     cleaned_timebox_state[audkey] = {}
@@ -682,11 +1041,609 @@ def _clean_state() -> None:
     _Ctx.state["timebox"] = cleaned_timebox_state
 
 
+# Join scheduler
+def _schedule_joins(sock: socket.socket) -> None:
+    # Channels are joined several at a time with comma-separated JOIN
+    # commands, paced by a token bucket so that the server's flood
+    # protection is not triggered.  A JOIN line may not exceed 510
+    # bytes excluding the trailing CRLF.
+    max_size = 510
+    now = _Ctx.monotonic()
+    due = []
+    for join in _Ctx.joins.values():
+        if join["state"] == "sent" and now - join["time"] >= _Ctx.join_timeout_seconds:
+            _join_result(join["name"], "No reply from server")
+        if join["state"] == "pending" or (
+            join["state"] == "failed" and now >= join["time"]
+        ):
+            due.append(join["name"])
+
+    index = 0
+    while index < len(due):
+        bucket = _refill_bucket(
+            _Ctx.join_bucket, "join", _Ctx.join_burst, _Ctx.join_refill_seconds, now
+        )
+        if bucket is not None:
+            if bucket["tokens"] < 1:
+                return
+            bucket["tokens"] -= 1
+
+        batch = [due[index]]
+        size = len(f"JOIN {due[index]}".encode())
+        index += 1
+        while index < len(due) and size + len(due[index].encode()) + 1 <= max_size:
+            batch.append(due[index])
+            size += len(due[index].encode()) + 1
+            index += 1
+
+        _send(sock, "JOIN " + ",".join(batch))
+        for channel in batch:
+            join = _Ctx.joins[_irc_lower(channel)]
+            join["state"] = "sent"
+            join["time"] = now
+            join["attempts"] += 1
+
+
+def _join_result(channel: str, error: str | None, *, retry: bool = True) -> None:
+    # A failed join is retried later with exponential backoff unless
+    # retrying cannot help.  For a failed join, the time field holds
+    # the time of the next attempt.
+    join = _Ctx.joins.get(_irc_lower(channel))
+    if join is None:
+        return
+    channel = join["name"]
+    if error is None:
+        join["state"] = "joined"
+        join["attempts"] = 0
+        joined = sum(1 for j in _Ctx.joins.values() if j["state"] == "joined")
+        _LOG.info("Joined %s (%d of %d)", channel, joined, len(_Ctx.joins))
+        return
+    if not retry:
+        join["state"] = "abandoned"
+        _LOG.error("Cannot join %s: %s; giving up", channel, error)
+        return
+    delay = min(_Ctx.join_retry_seconds * 2 ** max(join["attempts"] - 1, 0), 3600)
+    join["state"] = "failed"
+    join["time"] = _Ctx.monotonic() + delay
+    _LOG.warning("Cannot join %s: %s; retrying in %d s", channel, error, delay)
+
+
+def _irc_lower(name: str) -> str:
+    # RFC 1459 - 2.2: The characters {}| are the lower case equivalents
+    # of []\.  The rfc1459 casemapping also treats ~ as the lower case
+    # equivalent of ^.
+    return name.lower().translate(str.maketrans("[]\\^", "{}|~"))
+
+
+# Response cache
+def _run_command(
+    prefix: str,
+    person: str,
+    command: str,
+    params: list[str],
+    audience: str,
+    private: bool,
+) -> list[str]:
+    command_function = globals()[f"_{command}_command"]
+    if command not in _Ctx.cached_commands or len(params) > 0:
+        return command_function(prefix, person, command, params, audience, private)
+
+    # Only the mine command depends on the person who sent it, so the
+    # other cached commands share one entry across all senders.
+    audkey = "private" if private else audience
+    key = (command, audkey, person if command == "mine" else "", private)
+    version = _Ctx.versions.get(audkey, 0)
+    entry = _Ctx.response_cache.get(key)
+    if entry is not None and entry[0] == version:
+        _Ctx.response_cache.move_to_end(key)
+        return entry[1]
+
+    response = command_function(prefix, person, command, params, audience, private)
+    _Ctx.response_cache[key] = (version, response)
+    _Ctx.response_cache.move_to_end(key)
+    while len(_Ctx.response_cache) > _Ctx.cache_size:
+        _Ctx.response_cache.popitem(last=False)
+    return response
+
+
+def _bump_version(audkey: str) -> None:
+    _Ctx.versions[audkey] = _Ctx.versions.get(audkey, 0) + 1
+
+
+# Query API
+class _APIHandler(http.server.BaseHTTPRequestHandler):
+    """Answer read-only queries about timeboxes with JSON."""
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        status, result = _api_query(url.path, query)
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt: str, *args: object) -> None:
+        _LOG.debug(fmt, *args)
+
+
+def _start_api(port: int) -> None:
+    # Bind to the loopback interface only.  The server runs in its own
+    # thread, so slow clients cannot hold up the IRC loop.
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _APIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _LOG.info("Serving queries at http://127.0.0.1:%d/", port)
+
+
+def _api_query(  # noqa: PLR0911 (too-many-return-statements)
+    path: str, query: dict[str, str]
+) -> tuple[http.HTTPStatus, dict[str, Any]]:
+    # Examples: /running?channel=%23t0
+    #           /list?channel=%23t0&offset=0&limit=100
+    #           /mine?channel=%23t0&person=alice
+    #           /summary
+    name = path.strip("/")
+    if name not in ("running", "list", "mine", "summary"):
+        return http.HTTPStatus.NOT_FOUND, {"error": f"Unknown query: {path}"}
+
+    if name == "summary":
+        with _Ctx.lock:
+            count = _Ctx.state["count"]
+            minutes = _Ctx.state["minutes"]
+        average = round(minutes / count) if count > 0 else 0
+        return http.HTTPStatus.OK, {
+            "count": count,
+            "minutes": minutes,
+            "average": average,
+        }
+
+    channel = query.get("channel", "")
+    person = query.get("person", "")
+    if not channel or (name == "mine" and not person):
+        return http.HTTPStatus.BAD_REQUEST, {
+            "error": "Missing channel or person parameter"
+        }
+    try:
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 100))
+    except ValueError:
+        return http.HTTPStatus.BAD_REQUEST, {
+            "error": "Parameters offset and limit must be integers"
+        }
+    if offset < 0:
+        return http.HTTPStatus.BAD_REQUEST, {"error": "Offset must not be negative"}
+    if limit <= 0 or limit > _Ctx.api_max_limit:
+        return http.HTTPStatus.BAD_REQUEST, {
+            "error": f"Limit must be between 1 and {_Ctx.api_max_limit}"
+        }
+
+    # Copy the matching timeboxes while holding the lock and do the
+    # rest of the work after releasing it.
+    with _Ctx.lock:
+        persons = _Ctx.state["timebox"].get(channel, {})
+        if name == "mine":
+            persons = {person: persons.get(person, [])}
+        if name == "running":
+            rows = [
+                dict(timeboxes[-1], person=p)
+                for p, timeboxes in persons.items()
+                if len(timeboxes) > 0 and timeboxes[-1]["state"] == _TState.RUNNING
+            ]
+        else:
+            rows = [
+                dict(t, person=p)
+                for p, timeboxes in persons.items()
+                for t in timeboxes
+                if t["state"] == _TState.COMPLETED
+            ]
+
+    rows.sort(key=lambda x: x["start"], reverse=True)
+    for row in rows:
+        row.pop("audience", None)
+    return http.HTTPStatus.OK, {
+        "channel": channel,
+        "total": len(rows),
+        "offset": offset,
+        "limit": limit,
+        "timeboxes": rows[offset : offset + limit],
+    }
+
+
+# Traffic capture
+def _open_capture() -> None:
+    # Every capture file begins with a snapshot of the state, so that
+    # it can be replayed on its own.
+    path = pathlib.Path(_Ctx.capture_file)
+    _Ctx.capture_stream = path.open("ab")
+    _write_capture_record(b"S", json.dumps(_Ctx.state).encode())
+    _LOG.info("Capturing traffic to %s", path)
+
+
+def _capture(kind: bytes, data: bytes) -> None:
+    # Record format: timestamp (double), kind (one byte: '<' for
+    # received lines, '>' for sent lines, 'S' for state snapshots),
+    # length (unsigned int), then the raw bytes.  All big-endian.
+    stream = _Ctx.capture_stream
+    if stream is None:
+        return
+    try:
+        if kind == b"<" and stream.tell() >= _Ctx.capture_max_bytes:
+            _rotate_capture()
+        _write_capture_record(kind, data)
+    except OSError:
+        _LOG.exception("Cannot capture traffic; capture disabled")
+        _Ctx.capture_stream = None
+
+
+def _write_capture_record(kind: bytes, data: bytes) -> None:
+    if _Ctx.capture_stream is not None:
+        header = struct.pack("!dcI", _Ctx.clock(), kind, len(data))
+        _Ctx.capture_stream.write(header + data)
+        _Ctx.capture_stream.flush()
+
+
+def _rotate_capture() -> None:
+    # Every capture file also ends with a snapshot of the state, so that
+    # a replay can check its own state against it.  Then rename
+    # tzero.cap.1 to tzero.cap.2, tzero.cap to tzero.cap.1, etc.
+    if _Ctx.capture_stream is not None:
+        _write_capture_record(b"S", json.dumps(_Ctx.state).encode())
+        _Ctx.capture_stream.close()
+    base = _Ctx.capture_file
+    for i in range(_Ctx.capture_backups, 0, -1):
+        source = pathlib.Path(f"{base}.{i - 1}" if i > 1 else base)
+        if source.exists():
+            source.replace(f"{base}.{i}")
+    if _Ctx.capture_backups == 0:
+        pathlib.Path(base).unlink(missing_ok=True)
+    _open_capture()
+
+
+def _read_capture(filename: str) -> list[tuple[float, bytes, bytes]]:
+    records = []
+    header_size = struct.calcsize("!dcI")
+    with pathlib.Path(filename).open("rb") as stream:
+        while header := stream.read(header_size):
+            if len(header) < header_size:
+                break  # Truncated record at the end of the file.
+            timestamp, kind, size = struct.unpack("!dcI", header)
+            data = stream.read(size)
+            if len(data) < size:
+                break
+            records.append((timestamp, kind, data))
+    return records
+
+
+# Traffic replay
+class _ReplayClock:
+    """Clock that runs through a captured timeline at a given speed.
+
+    With a speed of None, the clock stands still at the timestamp of
+    the last line delivered to the client and sleeping advances it.
+    """
+
+    def __init__(self, start: float, speed: float | None) -> None:
+        self.start = start
+        self.speed = speed
+        self.now = start
+        self.real_start = time.monotonic()
+
+    def time(self) -> float:
+        if self.speed is None:
+            return self.now
+        return self.start + (time.monotonic() - self.real_start) * self.speed
+
+    def sleep(self, seconds: float) -> None:
+        if self.speed is None:
+            self.now += seconds
+        else:
+            time.sleep(seconds / self.speed)
+
+
+def _replay(config: dict[str, Any], filenames: list[str], speed: float | None) -> None:
+    records = [r for filename in filenames for r in _read_capture(filename)]
+    inbound = [(t, data) for t, kind, data in records if kind == b"<"]
+    snapshots = [data for _, kind, data in records if kind == b"S"]
+
+    # A snapshot taken after some received lines is a checkpoint: the
+    # replayed state should match it once the client has handled all
+    # the lines received before it.
+    checkpoints: dict[int, tuple[float, bytes]] = {}
+    received = 0
+    for timestamp, kind, data in records:
+        if kind == b"<":
+            received += 1
+        elif kind == b"S" and received > 0:
+            checkpoints[received] = (timestamp, data)
+    if len(inbound) == 0:
+        message = "No received lines found in capture"
+        raise ValueError(message)
+
+    # Start from the state at the beginning of the capture and keep
+    # the real state file out of harm's way.
+    _Ctx.state = (
+        json.loads(snapshots[0])
+        if snapshots
+        else {"count": 0, "minutes": 0, "timebox": {}}
+    )
+    _Ctx.response_cache.clear()
+    _Ctx.capture_stream = None
+    clock = _ReplayClock(inbound[0][0], speed)
+    _Ctx.clock = clock.time
+    _Ctx.monotonic = clock.time
+    _Ctx.sleep = clock.sleep
+    _LOG.setLevel(logging.WARNING)
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    server = _ReplayServer(listener, inbound, checkpoints, clock)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            _run(
+                host="127.0.0.1",
+                port=listener.getsockname()[1],
+                tls=False,
+                nick=config["nick"],
+                password=config["password"],
+                channels=config["channels"],
+                prefix=config["prefix"],
+                nimb_nick=config["nimb"],
+                state_filename=str(pathlib.Path(tmpdir) / "state.json"),
+            )
+        except Exception:  # noqa: BLE001 (blind-except)
+            _LOG.debug("Replay client stopped", exc_info=True)
+    wall = time.perf_counter() - started
+    thread.join()
+    listener.close()
+
+    # Compare messages sent to users in the original run and in the
+    # replay.  Message tags (e.g., multiline batch tags) are ignored.
+    original = collections.Counter(
+        _strip_tags(data) for _, kind, data in records if kind == b">"
+    )
+    replayed = collections.Counter(_strip_tags(data) for data in server.sent)
+    for counter in (original, replayed):
+        for line in list(counter):
+            if not line.startswith(b"PRIVMSG "):
+                del counter[line]
+
+    latencies = server.latencies or [0.0]
+    _report(
+        {
+            "lines": len(inbound),
+            "messages": len(server.latencies),
+            "wall_seconds": round(wall, 3),
+            "lines_per_second": round(len(inbound) / wall, 1),
+            "reply_ms_mean": round(statistics.fmean(latencies) * 1000, 3),
+            "reply_ms_p50": round(_percentile(latencies, 50) * 1000, 3),
+            "reply_ms_p99": round(_percentile(latencies, 99) * 1000, 3),
+            "reply_ms_max": round(max(latencies) * 1000, 3),
+            "replies_original": sum(original.values()),
+            "replies_replayed": sum(replayed.values()),
+            "replies_matched": sum((original & replayed).values()),
+            "replies_missing": sum((original - replayed).values()),
+            "replies_extra": sum((replayed - original).values()),
+            "state_checkpoints": len(server.states),
+            "state_diverged": sum(1 for d in server.states if any(d)),
+            "state_entries_missing": sum(d[0] for d in server.states),
+            "state_entries_extra": sum(d[1] for d in server.states),
+        }
+    )
+
+
+class _ReplayServer:
+    """Fake IRC server that sends captured lines to the replay client.
+
+    The server sends the captured lines to the client on schedule and
+    collects whatever the client sends back.  Every PRIVMSG is followed
+    by a PING with a sequence number.  The client handles lines in
+    order, so the matching PONG tells us when the client has finished
+    replying to that PRIVMSG.
+
+    Before each line, the clock is moved to the time the line arrived
+    and a PING makes the client run its periodic tasks at that time,
+    as it would have done while waiting for the line in the original
+    run.  State checkpoints wait for one more PING, so that those tasks
+    have finished before the state is compared.
+    """
+
+    def __init__(
+        self,
+        listener: socket.socket,
+        inbound: list[tuple[float, bytes]],
+        checkpoints: dict[int, tuple[float, bytes]],
+        clock: _ReplayClock,
+    ) -> None:
+        self.listener = listener
+        self.inbound = inbound
+        self.checkpoints = checkpoints
+        self.clock = clock
+        self.conn: socket.socket | None = None
+        self.buffer = b""
+        self.ping_times: dict[bytes, float] = {}
+        self.sync_pings: set[bytes] = set()
+        self.sent: list[bytes] = []
+        self.latencies: list[float] = []
+        self.states: list[tuple[int, int]] = []
+
+    def serve(self) -> None:
+        self.conn, _ = self.listener.accept()
+        clock = self.clock
+        try:
+            clock.real_start = time.monotonic()
+            for i, (timestamp, line) in enumerate(self.inbound):
+                self.advance(timestamp, f"{_NAME}-tick-{i}")
+                self.check_state(i)
+                self.conn.sendall(line + b"\r\n")
+                if _parse_line(line.decode(errors="replace"))[1] == "PRIVMSG":
+                    token = f"{_NAME}-replay-{i}".encode()
+                    self.ping_times[token] = time.monotonic()
+                    self.conn.sendall(b"PING :" + token + b"\r\n")
+                if clock.speed is None:
+                    self.wait(self.ping_times)
+                self.read(0)
+
+            # Wait for the client to catch up before hanging up.
+            self.wait(self.ping_times)
+            end = len(self.inbound)
+            if end in self.checkpoints:
+                self.advance(self.checkpoints[end][0], f"{_NAME}-tick-{end}")
+                self.check_state(end)
+        except (ConnectionError, OSError):
+            _LOG.warning("Replay server lost client", exc_info=True)
+        finally:
+            self.conn.close()
+
+    def read(self, timeout: float) -> None:
+        if self.conn is None:
+            return
+        rlist, _, _ = select.select([self.conn], [], [], max(timeout, 0))
+        if len(rlist) == 0:
+            return
+        data = self.conn.recv(65536)
+        if len(data) == 0:
+            raise ConnectionError
+        lines = (self.buffer + data).split(b"\r\n")
+        lines, self.buffer = lines[:-1], lines[-1]
+        for line in lines:
+            token = line.partition(b":")[2]
+            if line.startswith(b"PONG ") and token in self.ping_times:
+                sent_time = self.ping_times.pop(token)
+                self.latencies.append(time.monotonic() - sent_time)
+            elif line.startswith(b"PONG ") and token in self.sync_pings:
+                self.sync_pings.remove(token)
+            elif line.startswith(b"PING "):
+                self.conn.sendall(b"PONG :" + token + b"\r\n")
+            else:
+                self.sent.append(line)
+
+    def wait(self, pending: dict[bytes, float] | set[bytes]) -> None:
+        deadline = time.monotonic() + 60
+        while pending and time.monotonic() < deadline:
+            self.read(deadline - time.monotonic())
+
+    def advance(self, timestamp: float, token: str) -> None:
+        clock = self.clock
+        if clock.speed is not None:
+            due = clock.real_start + (timestamp - clock.start) / clock.speed
+            while time.monotonic() < due:
+                self.read(due - time.monotonic())
+        else:
+            clock.now = max(clock.now, timestamp)
+        self.sync(token)
+
+    def sync(self, token: str) -> None:
+        if self.conn is None:
+            return
+        self.sync_pings.add(token.encode())
+        self.conn.sendall(b"PING :" + token.encode() + b"\r\n")
+        self.wait(self.sync_pings)
+
+    def check_state(self, index: int) -> None:
+        checkpoint = self.checkpoints.get(index)
+        if checkpoint is None:
+            return
+        self.sync(f"{_NAME}-state-{index}")
+        with _Ctx.lock:
+            replayed = _state_entries(_Ctx.state)
+        original = _state_entries(json.loads(checkpoint[1]))
+        missing = sum((original - replayed).values())
+        extra = sum((replayed - original).values())
+        if missing or extra:
+            _LOG.warning(
+                "State diverged before line %d: %d missing, %d extra",
+                index + 1,
+                missing,
+                extra,
+            )
+        self.states.append((missing, extra))
+
+
+def _strip_tags(line: bytes) -> bytes:
+    return line.split(b" ", 1)[1] if line.startswith(b"@") else line
+
+
+def _state_entries(state: dict[str, Any]) -> collections.Counter[str]:
+    # Flatten the state into comparable entries: the totals and one
+    # entry per timebox.
+    entries = collections.Counter(
+        json.dumps([audkey, person, timebox], sort_keys=True)
+        for audkey, persons in state["timebox"].items()
+        for person, timeboxes in persons.items()
+        for timebox in timeboxes
+    )
+    entries[json.dumps(["count", state["count"]])] += 1
+    entries[json.dumps(["minutes", state["minutes"]])] += 1
+    return entries
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) * percent // 100, len(ordered) - 1)]
+
+
+def _report(result: dict[str, Any]) -> None:
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        sys.stdout.write(f"{key:<{width}}  {value}\n")
+
+
+# Blocklist
+def _load_blocklist() -> None:
+    # Each line of the blocklist file is a blocked word, except that
+    # lines of the form *text* block the text anywhere in a command.
+    words = list(_Ctx.block_words)
+    substrings = []
+    if _Ctx.block_file:
+        path = pathlib.Path(_Ctx.block_file)
+        stat = path.stat()
+        with path.open() as stream:
+            for line in stream:
+                entry = line.strip()
+                if len(entry) == 0 or entry.startswith("#"):
+                    continue
+                if entry[0] == entry[-1] == "*" and len(entry[1:-1]) > 0:
+                    substrings.append(entry[1:-1])
+                else:
+                    words.append(entry)
+        _Ctx.block_file_stat = (stat.st_mtime_ns, stat.st_size)
+    _Ctx.blocklist = _Blocklist(words, substrings)
+    _LOG.info(
+        "Loaded blocklist with %d words and %d substrings",
+        len(words),
+        len(substrings),
+    )
+
+
+def _reload_blocklist() -> None:
+    if not _Ctx.block_file:
+        return
+    # Keep the last loaded blocklist while the file is missing,
+    # unreadable or not valid UTF-8 and report the problem only once.
+    try:
+        stat = pathlib.Path(_Ctx.block_file).stat()
+        if (stat.st_mtime_ns, stat.st_size) != _Ctx.block_file_stat:
+            _load_blocklist()
+    except (OSError, ValueError) as e:
+        if not _Ctx.block_file_failed:
+            _LOG.error("Cannot reload blocklist from %s: %s", _Ctx.block_file, e)
+            _Ctx.block_file_failed = True
+    else:
+        _Ctx.block_file_failed = False
+
+
 # Utility functions
 def _read_state(filename: str) -> None:
     if pathlib.Path(filename).exists():
         with pathlib.Path(filename).open() as stream:
             _Ctx.state = json.load(stream)
+        _Ctx.response_cache.clear()
         _LOG.debug("Loaded state from %s: %s", filename, _Ctx.state)
     else:
         _LOG.debug("State file %s does not exist", filename)
@@ -698,6 +1655,19 @@ def _write_state(filename: str) -> None:
         json.dump(_Ctx.state, stream, indent=2)
 
 
+def _parse_speed(value: str) -> float | None:
+    if value == "max":
+        return None
+    try:
+        speed = float(value)
+    except ValueError:
+        speed = 0
+    if not speed > 0 or speed == float("inf"):
+        message = f"must be a number greater than 0 or 'max': {value!r}"
+        raise argparse.ArgumentTypeError(message)
+    return speed
+
+
 def _find_command(command: str) -> list[str]:
     return [c for c in _Ctx.commands if c.startswith(command)]
 
@@ -713,9 +1683,13 @@ def _remove_prefix(word: str, prefix: str) -> str:
 
 
 def _format_timebox(person: str, timebox: dict[str, Any]) -> str:
-    start = timebox["start"]
-    duration = timebox["duration"]
-    summary = timebox["summary"]
+    return _render_timebox(
+        person, timebox["start"], timebox["duration"], timebox["summary"]
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _render_timebox(person: str, start: int, duration: int, summary: str) -> str:
     start_str = time.strftime("%a %H:%M %Z", time.gmtime(start))
     return f"{person} [{start_str}] ({duration} min) {summary}"
 
@@ -744,8 +1718,30 @@ def _format_duration(seconds: int) -> str:
 
 
 # Protocol functions
+def _set_keepalive(sock: socket.socket) -> None:
+    # Let the operating system probe the connection too.  Keepalive
+    # probes are sent only while no data is waiting to be sent, so
+    # while we are sending, a dropped path is detected by limiting how
+    # long sent data may remain unacknowledged instead.
+    idle = max(_Ctx.ping_interval_seconds, 1)
+    interval = 10
+    count = 3
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):  # Linux
+        timeout_ms = (idle + interval * count) * 1000
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, timeout_ms)
+
+
 def _recv(sock: socket.socket) -> Iterator[str | None]:
-    buffer = ""
+    buffer = b""
     while True:
         # Check if any data has been received.
         rlist, _, _ = select.select([sock], [], [], 1)
@@ -760,29 +1756,179 @@ def _recv(sock: socket.socket) -> Iterator[str | None]:
             _LOG.error(message)
             raise ValueError(message)
 
-        # If there is nonempty data, yield lines from it.
-        buffer += data.decode(errors="replace")
-        lines = buffer.split("\r\n")
+        # If there is nonempty data, yield lines from it.  Lines are
+        # captured just before they are processed.
+        buffer += data
+        lines = buffer.split(b"\r\n")
         lines, buffer = lines[:-1], lines[-1]
-        for line in lines:
+        for raw_line in lines:
+            _capture(b"<", raw_line)
+            line = raw_line.decode(errors="replace")
             _LOG.info("recv: %s", line)
             yield line
 
 
 def _send_message(sock: socket.socket, recipient: str, message: str) -> None:
+    for chunk in _split_message(message):
+        _send(sock, f"PRIVMSG {recipient} :{chunk}")
+
+
+def _send_batch(sock: socket.socket, recipient: str, messages: list[str]) -> None:
+    # Pack as many lines as the server allows into each multiline
+    # batch, so that a whole reply is delivered as one unit.  A line
+    # too long for one message is sent in chunks, and each chunk after
+    # the first is marked to be joined to the previous one.
+    limits = _multiline_limits()
+    if limits is None:
+        message = "Multiline batches are not enabled"
+        raise ValueError(message)
+    max_bytes, max_lines = limits
+
+    chunks = [
+        (chunk, i > 0)
+        for msg in messages
+        for line in msg.splitlines()
+        for i, chunk in enumerate(_split_message(line))
+    ]
+    groups: list[list[tuple[str, bool]]] = []
+    group: list[tuple[str, bool]] = []
+    size = 0
+    for chunk, concat in chunks:
+        chunk_size = len(chunk.encode()) + (0 if concat else 1)
+        if group and (len(group) == max_lines or size + chunk_size > max_bytes):
+            groups.append(group)
+            group, size = [], 0
+        group.append((chunk, concat))
+        size += chunk_size
+    if group:
+        groups.append(group)
+
+    throttle_delay = 0
+    for group in groups:
+        _Ctx.sleep(throttle_delay)
+        throttle_delay = 1
+        if len(group) == 1:
+            _send(sock, f"PRIVMSG {recipient} :{group[0][0]}")
+            continue
+        _Ctx.batch_id += 1
+        ref = f"{_NAME}{_Ctx.batch_id}"
+        _send(sock, f"BATCH +{ref} draft/multiline {recipient}")
+        for i, (chunk, concat) in enumerate(group):
+            tags = f"batch={ref}"
+            if concat and i > 0:
+                tags += ";draft/multiline-concat"
+            _send(sock, f"@{tags} PRIVMSG {recipient} :{chunk}")
+        _send(sock, f"BATCH -{ref}")
+
+
+def _split_message(message: str) -> list[str]:
     size = 400
-    for line in message.splitlines():
-        chunks = [line[i : i + size] for i in range(0, len(line), size)]
-        for chunk in chunks:
-            _send(sock, f"PRIVMSG {recipient} :{chunk}")
+    return [
+        line[i : i + size]
+        for line in message.splitlines()
+        for i in range(0, len(line), size)
+    ]
 
 
 def _send(sock: socket.socket, message: str) -> None:
-    sock.sendall(message.encode() + b"\r\n")
+    data = message.encode()
+    sock.sendall(data + b"\r\n")
+    _capture(b">", b"PASS ..." if message.startswith("PASS ") else data)
     _LOG.info("sent: %s", message)
 
 
+def _handle_cap(
+    sock: socket.socket,
+    middle: str | None,
+    trailing: str | None,
+    available_caps: dict[str, str],
+) -> None:
+    # IRCv3 capability negotiation
+    # Example: :foo.example.com CAP * LS * :sasl batch
+    # Example: :foo.example.com CAP * LS :draft/multiline=max-bytes=4096
+    # Example: :foo.example.com CAP t0 ACK :sasl batch draft/multiline
+    # Example: :foo.example.com CAP t0 DEL :draft/multiline
+    params = (middle or "").split()
+    subcommand = params[1] if len(params) > 1 else ""
+    caps = (trailing or "").split()
+
+    if subcommand == "LS":
+        for cap in caps:
+            name, _, value = cap.partition("=")
+            available_caps[name] = value
+        if params[-1] != "*":  # Otherwise more LS lines follow.
+            _request_caps(sock, available_caps)
+    elif subcommand == "ACK":
+        for cap in caps:
+            if cap.startswith("-"):
+                _Ctx.caps.pop(cap[1:], None)
+            else:
+                _Ctx.caps[cap] = available_caps.get(cap, "")
+        _LOG.info("Enabled capabilities: %s", " ".join(_Ctx.caps))
+        if "sasl" in _Ctx.caps:
+            _send(sock, "AUTHENTICATE PLAIN")
+        else:
+            _send(sock, "CAP END")
+    elif subcommand == "NAK":
+        _LOG.warning("Capabilities rejected: %s", trailing)
+        _send(sock, "CAP END")
+    elif subcommand == "DEL":
+        # CAP LS 302 enables cap-notify, so the server may withdraw
+        # capabilities at any time.  Replies then fall back to one
+        # message per line.
+        for cap in caps:
+            _Ctx.caps.pop(cap, None)
+            available_caps.pop(cap, None)
+        _LOG.info("Disabled capabilities: %s", trailing)
+
+
+def _request_caps(sock: socket.socket, available_caps: dict[str, str]) -> None:
+    # Multiline batches are sent as tagged messages, so they are of no
+    # use without both batch and message-tags.
+    wanted = [c for c in _Ctx.wanted_caps if c in available_caps]
+    if not _Ctx.sasl and "sasl" in wanted:
+        wanted.remove("sasl")
+    if "draft/multiline" in wanted and not (
+        "batch" in wanted and "message-tags" in wanted
+    ):
+        wanted.remove("draft/multiline")
+    if wanted:
+        _send(sock, "CAP REQ :" + " ".join(wanted))
+    else:
+        _send(sock, "CAP END")
+
+
+def _send_sasl_plain(sock: socket.socket, nick: str, password: str) -> None:
+    # Payloads longer than 400 bytes are sent in 400 byte chunks.  A
+    # final chunk of exactly 400 bytes is followed by a lone '+'.
+    size = 400
+    payload = base64.b64encode(f"{nick}\0{nick}\0{password}".encode()).decode()
+    chunks = [payload[i : i + size] for i in range(0, len(payload), size)]
+    if len(chunks) == 0 or len(chunks[-1]) == size:
+        chunks.append("+")
+    for chunk in chunks:
+        sock.sendall(f"AUTHENTICATE {chunk}".encode() + b"\r\n")
+    _LOG.info("sent: AUTHENTICATE ...")
+
+
+def _multiline_limits() -> tuple[int, int] | None:
+    value = _Ctx.caps.get("draft/multiline")
+    if value is None or "batch" not in _Ctx.caps or "message-tags" not in _Ctx.caps:
+        return None
+    params = dict(p.partition("=")[::2] for p in value.split(","))
+    max_bytes = int(params.get("max-bytes") or 0)
+    max_lines = int(params.get("max-lines") or 0)
+    if max_bytes <= 0:
+        return None
+    return max_bytes, max_lines if max_lines > 0 else max_bytes
+
+
 def _parse_line(line: str) -> tuple[str | None, str, str | None, str | None]:
+    # IRCv3 message tags precede the message and are ignored here.
+    # Example: @time=2024-07-02T20:07:00.000Z :alice!Alice@user/alice ...
+    if line[0] == "@":
+        line = line.split(" ", 1)[1].lstrip(" ")
+
     # RFC 1459 - 2.3.1
     # <message>  ::= [':' <prefix> <SPACE> ] <command> <params> <crlf>
     # <prefix>   ::= <servername> | <nick> [ '!' <user> ] [ '@' <host> ]
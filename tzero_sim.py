@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""Simulate Tzero workloads against a virtual clock."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import pathlib
+import random
+import re
+import resource
+import statistics
+import sys
+import time
+from typing import Any
+
+import tzero
+
+# ruff: noqa: SLF001, S311
+
+_NICK = "t0"
+_COMPLETED_RE = re.compile(r"^PRIVMSG \S+ :Completed timebox in (\S+): (\S+) \[")
+_STARTED_RE = re.compile(r"^PRIVMSG \S+ :Started timebox ")
+_CANCELLED_RE = re.compile(r"^PRIVMSG \S+ :Cancelled running timebox: ")
+
+
+class _Clock:
+    def __init__(self, now: float) -> None:
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class _Socket:
+    def __init__(self) -> None:
+        self.lines: list[str] = []
+
+    def sendall(self, data: bytes) -> None:
+        self.lines.append(data.decode().rstrip("\r\n"))
+
+    def drain(self) -> list[str]:
+        lines, self.lines = self.lines, []
+        return lines
+
+
+class _Model:
+    """Expected completion times of running timeboxes."""
+
+    def __init__(self, multiplier: int) -> None:
+        self.multiplier = multiplier
+        self.running: dict[tuple[str, str], int] = {}
+        self.expected = 0
+        self.notified = 0
+        self.late = 0
+        self.max_delay = 0
+        self.early = 0
+        self.unexpected = 0
+
+    def observe_replies(
+        self, lines: list[str], audkey: str, person: str, duration: int, now: int
+    ) -> None:
+        for line in lines:
+            if _STARTED_RE.match(line):
+                self.running[(audkey, person)] = now + duration * self.multiplier
+                self.expected += 1
+            elif _CANCELLED_RE.match(line):
+                del self.running[(audkey, person)]
+                self.expected -= 1
+
+    def observe_notifications(self, lines: list[str], now: int, tick: int) -> None:
+        for line in lines:
+            matches = _COMPLETED_RE.match(line)
+            if matches is None:
+                continue
+            end = self.running.pop((matches.group(1), matches.group(2)), None)
+            if end is None:
+                self.unexpected += 1
+                continue
+            self.notified += 1
+            self.max_delay = max(self.max_delay, now - end)
+            if now < end:
+                self.early += 1
+            elif now - end > tick:
+                self.late += 1
+
+    def missing(self, now: int) -> int:
+        return sum(1 for end in self.running.values() if end <= now)
+
+
+def main() -> None:
+    """Run the simulation."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="etc/tzero.json")
+    parser.add_argument("--script", help="file of 'SECONDS SENDER TARGET MESSAGE'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--private-ratio", type=float, default=0.1)
+    parser.add_argument("--commands-per-tick", type=int, default=5)
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--tick-seconds", type=int, default=1)
+    parser.add_argument("--preload", type=int, default=0)
+    args = parser.parse_args()
+
+    with pathlib.Path(args.config).open() as stream:
+        config = json.load(stream)
+    tzero._configure(config)
+
+    rng = random.Random(args.seed)
+    clock = _Clock(1_700_000_000)
+    tzero._Ctx.clock = clock.time
+    tzero._Ctx.monotonic = clock.time
+    tzero._Ctx.sleep = clock.sleep
+    tzero._Ctx.state = {"count": 0, "minutes": 0, "timebox": {}}
+    _preload(rng, args.preload, args.channels, int(clock.now))
+
+    if args.script:
+        events = _read_script(args.script)
+    else:
+        events = _generate(rng, args, config["prefix"])
+
+    model = _Model(1 if tzero._Ctx.dev_mode else 60)
+    result = _simulate(args, config, clock, events, model)
+    missing = model.missing(int(clock.now) - args.tick_seconds)
+    result.update(
+        {
+            "notifications_expected": model.expected,
+            "notifications_sent": model.notified,
+            "notifications_early": model.early,
+            "notifications_late": model.late,
+            "notification_delay_max": model.max_delay,
+            "notifications_unexpected": model.unexpected,
+            "notifications_missing": missing,
+        }
+    )
+    tzero._report(result)
+    if model.early or model.unexpected or missing:
+        sys.exit(1)
+
+
+def _simulate(
+    args: argparse.Namespace,
+    config: dict[str, Any],
+    clock: _Clock,
+    events: list[tuple[int, str, str, str]],
+    model: _Model,
+) -> dict[str, Any]:
+    sock = _Socket()
+    tick_costs: list[float] = []
+    max_timeboxes = 0
+    commands = 0
+    errors = 0
+    begin = clock.now
+    started = time.perf_counter()
+
+    for tick in range(args.ticks):
+        elapsed = tick * args.tick_seconds
+        while events and events[-1][0] <= elapsed:
+            _, sender, target, message = events.pop()
+            duration = _begin_duration(message, config["prefix"])
+            now = int(clock.now)
+            try:
+                tzero._try_process_message(
+                    sock,  # type: ignore[arg-type]
+                    _NICK,
+                    config["prefix"],
+                    config["nimb"],
+                    sender,
+                    target,
+                    message,
+                )
+            except Exception:  # noqa: BLE001 (blind-except)
+                errors += 1
+            audkey = "private" if target == _NICK else target
+            model.observe_replies(sock.drain(), audkey, sender, duration, now)
+            commands += 1
+
+        cost_start = time.perf_counter()
+        tzero._complete_timeboxes(sock)  # type: ignore[arg-type]
+        tzero._clean_state()
+        tick_costs.append(time.perf_counter() - cost_start)
+
+        model.observe_notifications(sock.drain(), int(clock.now), args.tick_seconds)
+        if tick % 100 == 0:
+            max_timeboxes = max(max_timeboxes, _count_timeboxes())
+        clock.now = max(clock.now, begin + elapsed + args.tick_seconds)
+
+    wall = time.perf_counter() - started
+    return {
+        "ticks": args.ticks,
+        "commands": commands,
+        "command_errors": errors,
+        "virtual_seconds": int(clock.now - begin),
+        "wall_seconds": round(wall, 3),
+        "timeboxes_final": _count_timeboxes(),
+        "timeboxes_max": max(max_timeboxes, _count_timeboxes()),
+        "tick_ms_mean": round(statistics.fmean(tick_costs) * 1000, 3),
+        "tick_ms_p50": round(tzero._percentile(tick_costs, 50) * 1000, 3),
+        "tick_ms_p99": round(tzero._percentile(tick_costs, 99) * 1000, 3),
+        "tick_ms_max": round(max(tick_costs) * 1000, 3),
+        "max_rss_mb": round(_max_rss_bytes() / 2**20, 1),
+    }
+
+
+def _preload(rng: random.Random, count: int, channels: int, now: int) -> None:
+    keep = max(tzero._Ctx.keep_timeboxes, 1)
+    age = max(tzero._Ctx.keep_duration_seconds // 2, 1)
+    timebox_state = tzero._Ctx.state["timebox"]
+    person_index = 0
+    while count > 0:
+        audkey = f"#c{person_index % channels}"
+        person = f"p{person_index}"
+        size = min(keep, count)
+        starts = sorted(now - rng.randrange(age) for _ in range(size))
+        timebox_state.setdefault(audkey, {})[person] = [
+            {
+                "audience": audkey,
+                "start": start,
+                "duration": tzero._Ctx.default_duration_minutes,
+                "summary": f"Preloaded task {i}",
+                "state": tzero._TState.COMPLETED,
+            }
+            for i, start in enumerate(starts)
+        ]
+        tzero._Ctx.state["count"] += size
+        tzero._Ctx.state["minutes"] += size * tzero._Ctx.default_duration_minutes
+        count -= size
+        person_index += 1
+
+
+def _generate(
+    rng: random.Random, args: argparse.Namespace, prefix: str
+) -> list[tuple[int, str, str, str]]:
+    durations = list(
+        range(
+            tzero._Ctx.min_duration_minutes,
+            tzero._Ctx.max_duration_minutes + 1,
+            max(tzero._Ctx.duration_multiple_minutes, 1),
+        )
+    )
+    commands = ["begin"] * 12 + ["cancel", "list", "mine", "running", "delete"]
+    events = []
+    for tick in range(args.ticks):
+        for _ in range(args.commands_per_tick):
+            sender = f"u{rng.randrange(args.users)}"
+            if rng.random() < args.private_ratio:
+                target = _NICK
+            else:
+                target = f"#c{rng.randrange(args.channels)}"
+            command = rng.choice(commands)
+            if command == "begin":
+                message = f"{prefix}begin {rng.choice(durations)} Task {tick}"
+            else:
+                message = f"{prefix}{command}"
+            events.append((tick * args.tick_seconds, sender, target, message))
+    events.reverse()
+    return events
+
+
+def _read_script(filename: str) -> list[tuple[int, str, str, str]]:
+    events = []
+    with pathlib.Path(filename).open() as stream:
+        for line in stream:
+            if line.strip() and not line.startswith("#"):
+                seconds, sender, target, message = line.rstrip("\n").split(" ", 3)
+                events.append((int(seconds), sender, target, message))
+    events.sort(key=lambda x: x[0], reverse=True)
+    return events
+
+
+def _begin_duration(message: str, prefix: str) -> int:
+    words = message.split()
+    if len(words) > 1 and words[0].startswith(prefix) and words[1].isdigit():
+        return int(words[1])
+    return tzero._Ctx.default_duration_minutes
+
+
+def _count_timeboxes() -> int:
+    return sum(
+        len(timeboxes)
+        for persons in tzero._Ctx.state["timebox"].values()
+        for timeboxes in persons.values()
+    )
+
+
+def _max_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+if __name__ == "__main__":
+    main()